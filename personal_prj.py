@@ -4,8 +4,11 @@ import os
 import re
 import time
 import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
+from operator import itemgetter
 from typing import List, Optional
 import certifi
 import urllib3
@@ -14,7 +17,7 @@ from requests.exceptions import SSLError, RequestException
 from urllib3.util.retry import Retry
 
 import requests
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 
 
 # -----------------------------
@@ -24,38 +27,89 @@ BAOTINMANHHAI_URL = "https://baotinmanhhai.vn/vi/bang-gia-vang"
 
 REQUEST_TIMEOUT = 20  # giây
 TELEGRAM_RETRIES = 3
-TELEGRAM_RETRY_DELAY = 3  # giây
+TELEGRAM_RETRY_BASE_DELAY = 0.5  # giây, nhân đôi mỗi lần retry
+TELEGRAM_RETRY_MAX_DELAY = 16    # giây
+TELEGRAM_RETRY_BUDGET = 10       # giây, tổng thời gian chờ (sleep) tối đa giữa các lần retry
 
 GIST_FILE_NAME = "gold_price_snapshot.txt"  # file snapshot trên Gist
-LAST_DATA_FILE = "last_price.txt"           # fallback local (dev)
+LAST_DATA_FILE = "last_price.txt"           # fallback local (dev) / cache nội dung Gist
+GIST_ETAG_FILE = ".gist_etag"               # ETag lần đọc Gist gần nhất (If-None-Match)
 SNAPSHOT_PATH = "gold_snapshot.txt"         # file trung gian compare -> notify
+PAGE_HTML_PATH = "gold_page.html"           # HTML trang vàng compare đã tải -> notify
+PAGE_CACHE_META_FILE = ".page_cache_meta"   # ETag/Last-Modified của trang giá vàng
 SCREENSHOT_PATH = "gold_table.png"          # ảnh gửi Telegram
+SCREENSHOT_SCALE = 1                        # device_scale_factor (2 = nét hơn, ảnh nặng ~4x)
+
+# Header mặc định gắn vào SESSION (dùng chung cho mọi request)
+HTTP_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/120.0 Safari/537.36"
+    ),
+    "Accept": (
+        "text/html,application/xhtml+xml,application/xml;q=0.9,"
+        "image/avif,image/webp,image/apng,*/*;q=0.8"
+    ),
+    "Accept-Language": "vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Cache-Control": "no-cache",
+    "Pragma": "no-cache",
+}
+
+# Playwright: chặn request không cần cho ảnh chụp ngay ở tầng network
+SCREENSHOT_BLOCKED_HOSTS = (
+    "doubleclick.net",
+    "googlesyndication.com",
+    "googletagmanager.com",
+    "google-analytics.com",
+    "facebook.net",
+    "facebook.com",
+)
+SCREENSHOT_BLOCKED_TYPES = ("media", "font")
 
 
 # -----------------------------
 # Model dữ liệu
 # -----------------------------
-@dataclass
+@dataclass(slots=True, frozen=True)
 class GoldItem:
     name: str
     buy: Optional[int]
     sell: Optional[int]
     unit: str = "đồng/chỉ"
 
+    def __post_init__(self) -> None:
+        # name luôn ở dạng chuẩn hoá -> snapshot/dedupe dùng thẳng, không normalize lại
+        object.__setattr__(self, "name", normalize_text(self.name))
+
 
 # -----------------------------
 # Utils
 # -----------------------------
 def log(msg: str) -> None:
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+
+
+_WS_RE = re.compile(r"\s+")
+_DIGIT_RE = re.compile(r"\d")
+_NON_DIGIT_RE = re.compile(r"[^\d]")
 
 
 def normalize_text(s: str) -> str:
     s = (s or "").replace("\u00a0", " ").strip()
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RE.sub(" ", s)
     return s
 
 
+# Bảng xoá mọi ký tự Latin-1 không phải 0-9 (dấu chấm, phẩy, space, NBSP...)
+# + vài ký tự ngoài Latin-1 hay gặp trong ô giá (đơn vị đ/₫, gạch ngang)
+_NON_DIGIT_TABLE = str.maketrans(
+    "",
+    "",
+    "".join(chr(c) for c in range(256) if not 48 <= c <= 57) + "đĐ₫–—",
+)
+
+
 def parse_vnd(value: str) -> Optional[int]:
     """
     Chuyển '15.170.000' => 15170000
@@ -64,36 +118,38 @@ def parse_vnd(value: str) -> Optional[int]:
     value = (value or "").strip()
     if value in ("", "-", "—"):
         return None
-    digits = re.sub(r"[^\d]", "", value)
+    digits = value.translate(_NON_DIGIT_TABLE)
+    if not digits.isdecimal():
+        # còn ký tự ngoài Latin-1 (vd 'đ', '₫') -> lọc nốt bằng regex
+        digits = _NON_DIGIT_RE.sub("", digits)
     return int(digits) if digits else None
 
 
 def canonical_snapshot(items: List[GoldItem]) -> str:
     """
     Snapshot ổn định để lưu lên Gist:
-    - normalize name
+    - name đã normalize sẵn trong GoldItem
     - None -> '' cho buy/sell
     - sort theo name để chống reorder HTML
     """
-    rows = []
-    for it in items:
-        name = normalize_text(it.name)
-        buy = "" if it.buy is None else str(int(it.buy))
-        sell = "" if it.sell is None else str(int(it.sell))
-        rows.append((name, buy, sell))
-
-    rows.sort(key=lambda x: x[0])
-    return "\n".join([f"{n} | {b} | {s}" for n, b, s in rows]).strip()
+    rows = sorted(
+        (
+            (
+                it.name,
+                "" if it.buy is None else str(it.buy),
+                "" if it.sell is None else str(it.sell),
+            )
+            for it in items
+        ),
+        key=itemgetter(0),
+    )
+    return "\n".join(f"{n} | {b} | {s}" for n, b, s in rows).strip()
 
 
 def canonicalize_text_blob(s: str) -> str:
     return (s or "").replace("\u00a0", " ").replace("\r\n", "\n").strip()
 
 
-def sha256_text(s: str) -> str:
-    return hashlib.sha256((s or "").encode("utf-8")).hexdigest()
-
-
 def save_file(path: str, content: str) -> None:
     with open(path, "w", encoding="utf-8") as f:
         f.write(content or "")
@@ -121,6 +177,7 @@ def write_output(name: str, value: str) -> None:
 
 def build_requests_session() -> requests.Session:
     session = requests.Session()
+    session.headers.update(HTTP_HEADERS)
 
     retry = Retry(
         total=3,
@@ -132,21 +189,23 @@ def build_requests_session() -> requests.Session:
         raise_on_status=False,
     )
 
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
     session.mount("https://", adapter)
     session.mount("http://", adapter)
     return session
 
 
+# Session dùng chung: giữ keep-alive, tránh bắt tay TCP+TLS lại cho mỗi request
+SESSION = build_requests_session()
+
+
 def _http_get_with_ssl_fallback(
     url: str,
-    headers: dict,
+    headers: Optional[dict] = None,
     timeout: int = REQUEST_TIMEOUT,
 ) -> requests.Response:
-    session = build_requests_session()
-
     try:
-        resp = session.get(
+        resp = SESSION.get(
             url,
             headers=headers,
             timeout=timeout,
@@ -161,7 +220,7 @@ def _http_get_with_ssl_fallback(
     log("⚠️ Fallback sang verify=False cho baotinmanhhai.vn")
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    resp = session.get(
+    resp = SESSION.get(
         url,
         headers=headers,
         timeout=timeout,
@@ -174,25 +233,79 @@ def _http_get_with_ssl_fallback(
 # -----------------------------
 # Crawler (HTML mới)
 # -----------------------------
-def fetch_gold_page(url: str = BAOTINMANHHAI_URL) -> str:
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/120.0 Safari/537.36"
-        ),
-        "Accept": (
-            "text/html,application/xhtml+xml,application/xml;q=0.9,"
-            "image/avif,image/webp,image/apng,*/*;q=0.8"
-        ),
-        "Accept-Language": "vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7",
-        "Cache-Control": "no-cache",
-        "Pragma": "no-cache",
-    }
+def fetch_gold_page_response(
+    url: str = BAOTINMANHHAI_URL,
+    validators: Optional[dict] = None,
+) -> requests.Response:
+    """
+    GET trang giá vàng. Nếu có validators (etag / last_modified lần trước)
+    thì gửi conditional GET -> server có thể trả 304 (không body).
+    """
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
 
     log(f"Đang tải trang giá vàng: {url}")
     resp = _http_get_with_ssl_fallback(url, headers=headers, timeout=REQUEST_TIMEOUT)
-    return resp.text
+
+    # Trang là UTF-8. Header thiếu charset thì requests sẽ đoán encoding
+    # (quét cả body) hoặc mặc định ISO-8859-1 -> chốt luôn utf-8
+    if "charset" not in (resp.headers.get("Content-Type") or "").lower():
+        resp.encoding = "utf-8"
+    return resp
+
+
+def fetch_gold_page(url: str = BAOTINMANHHAI_URL) -> str:
+    return fetch_gold_page_response(url).text
+
+
+def load_page_cache_meta() -> dict:
+    try:
+        return json.loads(load_file(PAGE_CACHE_META_FILE) or "{}")
+    except ValueError:
+        return {}
+
+
+def save_page_cache_meta(resp: requests.Response, raw_hash: str, snapshot_text: str) -> None:
+    # Lưu kèm snapshot lúc đồng bộ: validator/hash chỉ đáng tin khi Gist vẫn giữ đúng snapshot này
+    meta = {
+        "etag": resp.headers.get("ETag") or "",
+        "last_modified": resp.headers.get("Last-Modified") or "",
+        "blake2b": raw_hash,
+        "snapshot": snapshot_text,
+    }
+    save_file(PAGE_CACHE_META_FILE, json.dumps(meta))
+
+
+# Parser dùng chung cho mọi lần parse: bỏ comment, không dựng bảng id (không dùng)
+_HTML_PARSER = lxml_html.HTMLParser(remove_comments=True, collect_ids=False)
+
+# XPath tương đương các CSS selector dùng cho 2 layout
+_XP_GOLD_ROOT = '//div[starts-with(@id, "gold_price_table-")]'
+_XP_LEGACY_TABLE = '//*[contains(concat(" ", normalize-space(@class), " "), " gold-table-content ")]'
+_XP_GRID_ROWS = './/div[contains(concat(" ", normalize-space(@class), " "), " grid ")]'
+
+
+def _gold_block_window(page_html: str) -> str:
+    """
+    Cắt HTML từ thẻ mở của block id^=gold_price_table- tới hết trang
+    (bỏ <head>, header, menu phía trước) để lxml dựng cây nhỏ hơn.
+    Không giới hạn phía sau -> không bao giờ mất row.
+    Không thấy block -> trả nguyên trang.
+    """
+    idx = page_html.find('id="gold_price_table-')
+    if idx == -1:
+        return page_html
+    start = page_html.rfind("<", 0, idx)
+    return page_html[start:] if start != -1 else page_html
+
+
+def _node_text(el) -> str:
+    # tương đương get_text(" ", strip=True) + normalize_text
+    return normalize_text(" ".join(el.itertext()))
 
 
 def _extract_price_from_block(block) -> Optional[int]:
@@ -203,17 +316,19 @@ def _extract_price_from_block(block) -> Optional[int]:
     if block is None:
         return None
 
+    # text_content() = XPath string(): nối text trong C, không cần normalize
+    # vì parse_vnd bỏ hết ký tự không phải số
+
     # Ưu tiên span vì layout mới chứa đúng giá trong span
-    for el in block.select("span"):
-        txt = normalize_text(el.get_text(" ", strip=True))
-        if re.search(r"\d", txt):
+    for el in block.iterdescendants("span"):
+        txt = el.text_content()
+        if _DIGIT_RE.search(txt):
             val = parse_vnd(txt)
             if val is not None:
                 return val
 
     # fallback: lấy toàn bộ text
-    txt = normalize_text(block.get_text(" ", strip=True))
-    return parse_vnd(txt)
+    return parse_vnd(block.text_content())
 
 
 def parse_gold_table(page_html: str) -> List[GoldItem]:
@@ -222,33 +337,35 @@ def parse_gold_table(page_html: str) -> List[GoldItem]:
     1) Layout mới: div/grid dưới block id^=gold_price_table-
     2) Layout cũ: table/tbody/tr/td
     """
-    soup = BeautifulSoup(page_html, "html.parser")
+    # lxml trực tiếp (C/libxml2), không bọc mỗi node thành object Python như bs4
+    window = _gold_block_window(page_html)
+    tree = lxml_html.document_fromstring(window, parser=_HTML_PARSER)
 
     # =========================================================
     # A. Layout mới: div/grid
     # =========================================================
-    root = soup.select_one('div[id^="gold_price_table-"]')
+    roots = tree.xpath(_XP_GOLD_ROOT)
     items: List[GoldItem] = []
 
-    if root:
+    if roots:
         seen = set()
 
-        for row in root.select("div.grid"):
-            # Lấy các child trực tiếp của row
-            children = [c for c in row.find_all(recursive=False) if getattr(c, "name", None)]
+        for row in roots[0].xpath(_XP_GRID_ROWS):
+            # Lấy 3 child (element) trực tiếp đầu tiên của row
+            children = row.xpath("./*[position() <= 3]")
             if len(children) < 3:
                 continue
 
             # Tên sản phẩm: ưu tiên h3/span, fallback img alt
             name = ""
-            name_el = row.select_one("h3 span") or row.select_one("h3")
-            if name_el:
-                name = normalize_text(name_el.get_text(" ", strip=True))
+            name_els = row.xpath("(.//h3//span)[1]") or row.xpath("(.//h3)[1]")
+            if name_els:
+                name = _node_text(name_els[0])
 
             if not name:
-                img = row.select_one("img[alt]")
-                if img:
-                    name = normalize_text(img.get("alt", ""))
+                imgs = row.xpath("(.//img[@alt])[1]")
+                if imgs:
+                    name = normalize_text(imgs[0].get("alt", ""))
 
             # Bỏ header row hoặc row rác
             if not name:
@@ -265,7 +382,7 @@ def parse_gold_table(page_html: str) -> List[GoldItem]:
                 continue
 
             # chống duplicate theo name
-            key = normalize_text(name).lower()
+            key = name.lower()
             if key in seen:
                 continue
             seen.add(key)
@@ -278,13 +395,16 @@ def parse_gold_table(page_html: str) -> List[GoldItem]:
     # =========================================================
     # B. Fallback layout cũ: table
     # =========================================================
-    table = soup.select_one(".gold-table-content") or soup.select_one("table")
-    if table:
+    if window is not page_html:
+        # bảng cũ có thể nằm trước block mới -> parse lại cả trang
+        tree = lxml_html.document_fromstring(page_html, parser=_HTML_PARSER)
+
+    tables = tree.xpath(_XP_LEGACY_TABLE) or tree.xpath("//table")
+    if tables:
+        table = tables[0]
+
         # xác định cột theo header nếu có
-        header_cells = [
-            normalize_text(x.get_text(" ", strip=True)).lower()
-            for x in table.select("thead th")
-        ]
+        header_cells = [_node_text(x).lower() for x in table.xpath(".//thead//th")]
 
         idx_name = 0
         idx_buy = 1
@@ -297,14 +417,17 @@ def parse_gold_table(page_html: str) -> List[GoldItem]:
                 elif "bán" in h or "ban" in h:
                     idx_sell = i
 
-        for tr in table.select("tbody tr"):
-            tds = tr.find_all("td")
+        # chỉ cần tới cột xa nhất đang đọc
+        cell_limit = max(idx_name, idx_buy, idx_sell, 2) + 1
+
+        for tr in table.xpath(".//tbody//tr"):
+            tds = tr.xpath(f"(.//td)[position() <= {cell_limit}]")
             if len(tds) < 3:
                 continue
 
-            name = normalize_text(tds[idx_name].get_text(" ", strip=True))
-            buy = parse_vnd(tds[idx_buy].get_text(" ", strip=True)) if idx_buy < len(tds) else None
-            sell = parse_vnd(tds[idx_sell].get_text(" ", strip=True)) if idx_sell < len(tds) else None
+            name = _node_text(tds[idx_name])
+            buy = parse_vnd(tds[idx_buy].text_content()) if idx_buy < len(tds) else None
+            sell = parse_vnd(tds[idx_sell].text_content()) if idx_sell < len(tds) else None
 
             if not name or (buy is None and sell is None):
                 continue
@@ -330,22 +453,41 @@ def get_gist_token() -> Optional[str]:
 
 
 def load_last_data_from_gist(token: str, gist_id: str) -> str:
+    """
+    Conditional GET: gửi If-None-Match với ETag lần trước.
+    Gist chưa đổi -> 304 (không body), dùng lại nội dung cache ở LAST_DATA_FILE.
+    """
     url = f"https://api.github.com/gists/{gist_id}"
     headers = {"Authorization": f"Bearer {token}", "Accept": "application/vnd.github+json"}
-    resp = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+
+    etag = load_file(GIST_ETAG_FILE).strip()
+    cached = load_file(LAST_DATA_FILE)
+    if etag and cached:
+        headers["If-None-Match"] = etag
+
+    resp = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if resp.status_code == 304:
+        log("ℹ️ Gist không đổi (304), dùng snapshot cache local.")
+        return cached
     if resp.status_code == 404:
         return ""
     resp.raise_for_status()
     data = resp.json()
     file_obj = data.get("files", {}).get(GIST_FILE_NAME)
-    return (file_obj or {}).get("content") or ""
+    content = (file_obj or {}).get("content") or ""
+
+    new_etag = resp.headers.get("ETag")
+    if new_etag:
+        save_file(LAST_DATA_FILE, content)
+        save_file(GIST_ETAG_FILE, new_etag)
+    return content
 
 
 def save_last_data_to_gist(token: str, gist_id: str, text: str) -> None:
     url = f"https://api.github.com/gists/{gist_id}"
     headers = {"Authorization": f"Bearer {token}", "Accept": "application/vnd.github+json"}
     payload = {"files": {GIST_FILE_NAME: {"content": text}}}
-    resp = requests.patch(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+    resp = SESSION.patch(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
     resp.raise_for_status()
 
 
@@ -378,6 +520,20 @@ def save_last_snapshot(text: str) -> None:
 # -----------------------------
 # Telegram: sendPhoto
 # -----------------------------
+def _telegram_retry_delay(error: Exception, attempt: int) -> float:
+    """
+    429 -> chờ đúng parameters.retry_after Telegram trả về.
+    Lỗi khác -> exponential backoff: 0.5s, 1s, 2s... (tối đa TELEGRAM_RETRY_MAX_DELAY).
+    """
+    resp = getattr(error, "response", None)
+    if resp is not None and resp.status_code == 429:
+        try:
+            return float(resp.json().get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            return 1.0
+    return min(TELEGRAM_RETRY_MAX_DELAY, TELEGRAM_RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+
+
 def send_telegram_photo(
     bot_token: str,
     chat_id: str,
@@ -387,6 +543,10 @@ def send_telegram_photo(
 ) -> None:
     url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
     last_error: Optional[Exception] = None
+    # Ngân sách chỉ tính thời gian sleep, không tính thời gian request
+    # (upload chậm / timeout vẫn được retry như cũ)
+    slept = 0.0
+    attempt = 0
 
     for attempt in range(1, retries + 1):
         try:
@@ -394,7 +554,7 @@ def send_telegram_photo(
             with open(photo_path, "rb") as f:
                 files = {"photo": f}
                 data = {"chat_id": chat_id, "caption": caption}
-                r = requests.post(
+                r = SESSION.post(
                     url,
                     data=data,
                     files=files,
@@ -407,44 +567,71 @@ def send_telegram_photo(
         except Exception as e:
             last_error = e
             log(f"❌ Lỗi gửi Telegram photo: {e}")
-            if attempt < retries:
-                log(f"👉 Thử lại sau {TELEGRAM_RETRY_DELAY}s...")
-                time.sleep(TELEGRAM_RETRY_DELAY)
+            if attempt >= retries:
+                break
 
-    raise RuntimeError(f"Gửi Telegram photo thất bại sau {retries} lần") from last_error
+            delay = _telegram_retry_delay(e, attempt)
+            if slept + delay > TELEGRAM_RETRY_BUDGET:
+                log(f"⏹ Hết ngân sách retry {TELEGRAM_RETRY_BUDGET}s, dừng.")
+                break
+            log(f"👉 Thử lại sau {delay:g}s...")
+            time.sleep(delay)
+            slept += delay
+
+    raise RuntimeError(f"Gửi Telegram photo thất bại sau {attempt} lần") from last_error
 
 
 # -----------------------------
 # Screenshot: Playwright (lazy import)
 # -----------------------------
+def _block_unneeded_requests(route) -> None:
+    """
+    Abort quảng cáo/analytics, media, font và ảnh/CSS của bên thứ 3.
+    Ảnh sản phẩm của baotinmanhhai.vn vẫn được tải để bảng hiển thị đúng.
+    """
+    req = route.request
+    url = req.url
+
+    if any(host in url for host in SCREENSHOT_BLOCKED_HOSTS):
+        route.abort()
+    elif req.resource_type in SCREENSHOT_BLOCKED_TYPES:
+        route.abort()
+    elif req.resource_type in ("image", "stylesheet") and "baotinmanhhai" not in url:
+        route.abort()
+    else:
+        route.continue_()
+
+
 def capture_gold_table_screenshot(out_path: str = SCREENSHOT_PATH) -> str:
     """
     Chụp bảng giá vàng theo cách ổn định:
-    - requests lấy HTML
-    - BeautifulSoup bóc đúng block hiện tại
+    - dùng lại HTML bước compare đã lưu (fallback: requests lấy HTML)
+    - lxml bóc đúng block hiện tại
     - render local bằng Playwright
     - screenshot element
     """
     from playwright.sync_api import sync_playwright
 
-    html_text = fetch_gold_page(BAOTINMANHHAI_URL)
-    soup = BeautifulSoup(html_text, "html.parser")
-
-    # Ưu tiên layout mới
-    root = soup.select_one('div[id^="gold_price_table-"]')
-
-    # fallback layout cũ
-    if not root:
-        root = soup.select_one(".gold-table-content")
-    if not root:
-        root = soup.select_one(".table-responsive.gold-table")
-    if not root:
-        root = soup.select_one("table")
+    html_text = load_file(PAGE_HTML_PATH)
+    if not html_text:
+        html_text = fetch_gold_page(BAOTINMANHHAI_URL)
+    tree = lxml_html.document_fromstring(html_text, parser=_HTML_PARSER)
+
+    # Ưu tiên layout mới, fallback layout cũ
+    roots = (
+        tree.xpath(_XP_GOLD_ROOT)
+        or tree.xpath(_XP_LEGACY_TABLE)
+        or tree.xpath(
+            '//*[contains(concat(" ", normalize-space(@class), " "), " table-responsive ")'
+            ' and contains(concat(" ", normalize-space(@class), " "), " gold-table ")]'
+        )
+        or tree.xpath("//table")
+    )
 
-    if not root:
+    if not roots:
         raise RuntimeError("Không tìm thấy block bảng giá vàng để chụp")
 
-    target_html = str(root)
+    target_html = lxml_html.tostring(roots[0], encoding="unicode", with_tail=False)
 
     doc = f"""
 <!doctype html>
@@ -625,9 +812,10 @@ def capture_gold_table_screenshot(out_path: str = SCREENSHOT_PATH) -> str:
         )
         page = browser.new_page(
             viewport={"width": 1600, "height": 2200},
-            device_scale_factor=2,
+            device_scale_factor=SCREENSHOT_SCALE,
         )
         page.set_default_timeout(60_000)
+        page.route("**/*", _block_unneeded_requests)
         page.set_content(doc, wait_until="domcontentloaded")
 
         # ưu tiên block mới
@@ -652,28 +840,64 @@ def capture_gold_table_screenshot(out_path: str = SCREENSHOT_PATH) -> str:
 # -----------------------------
 def cmd_compare() -> None:
     """
-    1) crawl+parse -> snapshot_text
-    2) load last snapshot from gist/file
-    3) compare hash
-    4) write snapshot_text to SNAPSHOT_PATH
+    1) crawl HTML (conditional GET) + load last snapshot from gist/file (song song)
+       -> 304 / HTML trùng byte lần trước: output changed=false và dừng luôn
+    2) parse -> snapshot_text
+    3) compare snapshot text
+    4) write snapshot_text to SNAPSHOT_PATH (+ raw HTML to PAGE_HTML_PATH cho notify)
     5) output changed=true/false
     """
-    items = get_gold_price()
+    page_meta = load_page_cache_meta()
+
+    # 2 request độc lập (baotinmanhhai.vn / api.github.com) -> chạy chồng lên nhau
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        page_future = pool.submit(fetch_gold_page_response, BAOTINMANHHAI_URL, page_meta)
+        last_future = pool.submit(load_last_snapshot)
+        resp = page_future.result()
+        last_text = last_future.result()
+
+    # Meta chỉ khớp khi được lưu cùng snapshot mà Gist đang giữ.
+    # Đã notify thay đổi khác từ đó -> trang quay lại bản cũ vẫn phải được phát hiện.
+    old_text = canonicalize_text_blob(last_text)
+    meta_in_sync = page_meta.get("snapshot") == old_text
+
+    if resp.status_code == 304:
+        if meta_in_sync:
+            log("ℹ️ Trang giá vàng không đổi (304), bỏ qua parse.")
+            write_output("changed", "false")
+            return
+        log("ℹ️ 304 nhưng snapshot đã đổi từ lúc lưu ETag, tải lại trang đầy đủ.")
+        resp = fetch_gold_page_response(BAOTINMANHHAI_URL)
+
+    # Hash bytes thô trước khi parse: trang y hệt lần trước thì khỏi dựng DOM
+    # (chỉ để phát hiện thay đổi, không cần SHA-256 -> BLAKE2b 128-bit nhanh hơn)
+    raw_hash = hashlib.blake2b(resp.content, digest_size=16).hexdigest()
+    if meta_in_sync and raw_hash == page_meta.get("blake2b"):
+        log("ℹ️ HTML trang giá vàng trùng với lần trước, bỏ qua parse.")
+        write_output("changed", "false")
+        return
+
+    page_html = resp.text
+    items = parse_gold_table(page_html)
     snapshot_text = canonical_snapshot(items)
     save_file(SNAPSHOT_PATH, snapshot_text)
+    save_file(PAGE_HTML_PATH, page_html)
 
-    last_text = load_last_snapshot()
-    new_hash = sha256_text(snapshot_text)
-    old_hash = sha256_text(canonicalize_text_blob(last_text))
-
-    changed = "true" if new_hash != old_hash else "false"
-    log(f"Compare hash: {old_hash[:8]} -> {new_hash[:8]} changed={changed}")
+    # Snapshot chỉ vài trăm byte -> so sánh thẳng chuỗi, không cần hash
+    changed = "true" if snapshot_text != old_text else "false"
+    log(f"Compare snapshot: {len(old_text)} -> {len(snapshot_text)} chars changed={changed}")
     write_output("changed", changed)
 
+    # Chỉ lưu ETag/Last-Modified/hash khi snapshot đã khớp trang hiện tại.
+    # Nếu changed=true mà lưu luôn, notify lỗi -> lần sau 304 sẽ che mất thay đổi chưa gửi.
+    if changed == "false":
+        save_page_cache_meta(resp, raw_hash, snapshot_text)
+
 
 def cmd_notify() -> None:
     """
     1) read snapshot_text from SNAPSHOT_PATH
+       -> trùng snapshot trên gist/file thì dừng, không bật Chromium
     2) chụp screenshot bảng vàng
     3) sendPhoto
     4) update gist snapshot ONLY after send success
@@ -687,6 +911,12 @@ def cmd_notify() -> None:
     if not snapshot_text:
         raise RuntimeError(f"Không có snapshot text ở {SNAPSHOT_PATH}")
 
+    # Guard: Playwright là bước đắt nhất -> chỉ chạy khi snapshot thật sự khác
+    last_text = load_last_snapshot()
+    if snapshot_text == canonicalize_text_blob(last_text):
+        log("ℹ️ Snapshot không đổi so với lần gửi trước, bỏ qua notify.")
+        return
+
     img_path = capture_gold_table_screenshot(SCREENSHOT_PATH)
 
     caption = f"🪙 Giá vàng Bảo Tín Mạnh Hải\n⏱ {datetime.now().strftime('%H:%M %d/%m/%Y')}"